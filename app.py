@@ -1,12 +1,25 @@
 import streamlit as st
-from langchain.llms import OpenAI
-from crewai import Agent, Task, Crew
+from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.utils.json import parse_partial_json
+from gptcache import Cache, Config
+from gptcache.adapter.api import init_similar_cache, get as semantic_get, put as semantic_put
 import assemblyai as aai
-import requests
+import httpx
 import os
-import time
+import asyncio
+import orjson
+import tiktoken
 import threading
+import copy
+import functools
+import logging
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import pandas as pd
+import numpy as np
+from numba import njit
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Set up Streamlit page
 st.title("Real-Time HubSpot Call Analysis Dashboard")
@@ -14,155 +27,535 @@ st.header("Instant Feedback for Sales Representatives")
 st.markdown("Process live HubSpot call data with 3-5 second feedback delay and log to CRM.")
 
 # Initialize APIs
-llm = OpenAI(model="gpt-4o-mini", api_key=os.getenv("OPENAI_API_KEY"))
 aai.settings.api_key = os.getenv("ASSEMBLYAI_API_KEY")
 HUBSPOT_API_KEY = os.getenv("HUBSPOT_API_KEY")
 CONTACT_ID = os.getenv("HUBSPOT_CONTACT_ID", "CONTACT_ID")  # Replace with Faiz Ahmad's contact ID
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", ".gptcache")
+SEMANTIC_CACHE_THRESHOLD = 0.85  # Minimum similarity for a rephrased chunk to reuse a prior analysis
+CHUNK_TOKEN_BUDGET = 400  # Longer chunks keep only their most recent tokens
+TRANSCRIPT_WINDOW = 50  # Transcript chunks shown unless the full transcript is requested
+SENTIMENT_HISTORY_CAP = 1024  # Per-chunk sentiment scores kept for the trend chart
+SENTIMENT_WINDOW = 3  # Chunks averaged per point on the trend chart
+TRANSCRIBER_IDLE_TIMEOUT = 60.0  # Seconds an unused AssemblyAI connection stays open between runs
+HUBSPOT_MAX_REQUESTS, HUBSPOT_WINDOW = 9, 5.0  # Stay under HubSpot's burst limit (requests per seconds)
+HUBSPOT_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HUBSPOT_MAX_ATTEMPTS = 5
 
 # Session state
-if "transcript" not in st.session_state:
-    st.session_state.transcript = ""
-if "running" not in st.session_state:
-    st.session_state.running = False
+if "transcript_parts" not in st.session_state:
+    st.session_state.transcript_parts = []
 if "results" not in st.session_state:
-    st.session_state.results = {"sentiment": {}, "key_phrases": [], "feedback": []}
-
-# CrewAI agents
-sentiment_analyst = Agent(
-    role="Sentiment Analyst",
-    goal="Analyze sentiment of call transcript in real-time",
-    backstory="Expert in real-time NLP",
-    verbose=True,
-    llm=llm
-)
-feedback_generator = Agent(
-    role="Feedback Generator",
-    goal="Extract key phrases and provide instant feedback",
-    backstory="Sales coach for real-time analysis",
-    verbose=True,
-    llm=llm
+    st.session_state.results = {"sentiment": {}, "key_phrases": set(), "feedback": []}  # key_phrases deduplicated across chunks
+
+# One preallocated array per score, indexed by chunk (minus sentiment_offset once the cap has
+# forced a shift); chart frames are built from views, not per-chunk dicts. sentiment_count is
+# the length of the filled prefix, so out-of-order analyses never put the trend out of call order.
+def reset_sentiment_history():
+    st.session_state.sent_pos = np.zeros(SENTIMENT_HISTORY_CAP, np.float32)
+    st.session_state.sent_neg = np.zeros(SENTIMENT_HISTORY_CAP, np.float32)
+    st.session_state.sent_neu = np.zeros(SENTIMENT_HISTORY_CAP, np.float32)
+    st.session_state.sent_filled = np.zeros(SENTIMENT_HISTORY_CAP, np.bool_)
+    st.session_state.sentiment_offset = 0
+    st.session_state.sentiment_count = 0
+
+if "sentiment_count" not in st.session_state:
+    reset_sentiment_history()
+if "live_analysis" not in st.session_state:
+    st.session_state.live_analysis = ""
+if "stream_notices" not in st.session_state:
+    st.session_state.stream_notices = []  # (level, message) shown with the results
+
+# Sample call used when no audio is available
+transcript_chunks = [
+    "Agent: Hello, this is a test discovery call from Test Corp. We provide customized marketing solutions to enhance your business growth. Can you share your current marketing challenges?",
+    "Prospect: We’re struggling with lead generation and need better ROI on our campaigns.",
+    "Agent: That’s a common challenge. Our solutions can optimize your campaigns using data-driven strategies. Can you describe your target audience?",
+    "Prospect: Mostly small businesses. I’d like to know more about your pricing and implementation process.",
+    "Agent: Let’s schedule a follow-up to discuss pricing and tailor a plan. Does next week work?",
+    "Prospect: Yes, let’s do Tuesday."
+]
+
+# LLM client (built once per process instead of on every rerun)
+@st.cache_resource
+def get_llm():
+    # No LangChain LLM cache: streamed calls bypass it, so the persistent GPTCache store below
+    # covers repeated (and similar) chunks across restarts instead
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        api_key=os.getenv("OPENAI_API_KEY"),
+        model_kwargs={"response_format": {"type": "json_object"}}
+    )
+
+llm = get_llm()
+
+# Sentiment and coaching feedback are requested in one call per chunk; the prompt is
+# compiled once and only the chunk text is filled in per call
+ANALYSIS_PROMPT = (
+    "You are a real-time sales call analyst and sales coach. "
+    "For the transcript chunk you receive, analyze its sentiment, extract key phrases and give "
+    "instant feedback to the sales representative. Respond with a strict JSON object of the form "
+    '{{"sentiment": {{"positive": float, "negative": float, "neutral": float}}, '
+    '"key_phrases": [string], "feedback": [string]}}.'
 )
 
-# Analyze transcript chunk
-def analyze_chunk(chunk):
+@st.cache_resource
+def get_analysis_chain():
+    prompt = ChatPromptTemplate.from_messages([("system", ANALYSIS_PROMPT), ("human", "{chunk}")])
+    return prompt | llm
+
+analysis_chain = get_analysis_chain()
+
+# Tokenizer for trimming long chunks before they reach the model
+@st.cache_resource
+def get_encoder():
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+encoder = get_encoder()
+
+# Semantic cache: embeds chunks (ONNX) into a SQLite + FAISS store so rephrased utterances hit.
+# It is an optimization only, so if its backends cannot be loaded the app runs without it.
+# The store is shared by every session and its FAISS/SQL layers are not thread-safe, so all
+# lookups and inserts go through the lock returned alongside it.
+@st.cache_resource
+def get_semantic_cache():
+    semantic_cache = Cache()
     try:
-        sentiment_task = Task(
-            description=f"Analyze sentiment: {chunk}",
-            agent=sentiment_analyst,
-            expected_output="Dictionary with positive, negative, neutral scores"
-        )
-        feedback_task = Task(
-            description=f"Extract key phrases and provide feedback: {chunk}",
-            agent=feedback_generator,
-            expected_output="Dictionary with key_phrases (list) and feedback (list)"
+        init_similar_cache(
+            data_dir=SEMANTIC_CACHE_DIR,
+            cache_obj=semantic_cache,
+            config=Config(similarity_threshold=SEMANTIC_CACHE_THRESHOLD)
         )
-        crew = Crew(agents=[sentiment_analyst, feedback_generator], tasks=[sentiment_task, feedback_task], verbose=2)
-        result = crew.kickoff()
-        return eval(result.tasks_output[0].raw), eval(result.tasks_output[1].raw)
+    except Exception:
+        logging.getLogger(__name__).warning("Semantic cache unavailable; analyzing every chunk", exc_info=True)
+        return None, threading.Lock()
+    return semantic_cache, threading.Lock()
+
+semantic_cache, semantic_cache_lock = get_semantic_cache()
+
+# HubSpot client: one HTTP/2 connection pool driven by a background event loop, shared by every
+# session in the process. The semaphore admits HUBSPOT_MAX_REQUESTS calls per HUBSPOT_WINDOW.
+@st.cache_resource
+def get_hubspot_client():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    client = httpx.AsyncClient(http2=True, headers={"Authorization": f"Bearer {HUBSPOT_API_KEY}"}, timeout=10)
+    return loop, client, asyncio.Semaphore(HUBSPOT_MAX_REQUESTS)
+
+hubspot_loop, hubspot_client, hubspot_slots = get_hubspot_client()
+
+# Analyze transcript chunk
+# Cached on the normalized chunk so Streamlit reruns replaying the same utterance skip the LLM;
+# the leading underscore keeps the raw text and the progress callback out of the cache key.
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def run_analysis(chunk_key, _chunk, _on_partial=None):
+    cached = None
+    if semantic_cache is not None:
+        with semantic_cache_lock:
+            cached = semantic_get(chunk_key, cache_obj=semantic_cache)
+    if cached is not None:
+        result = orjson.loads(cached)
+    else:
+        buffer = ""
+        for token in analysis_chain.stream({"chunk": _chunk}):
+            buffer += token.content
+            if _on_partial is not None:
+                _on_partial(buffer)
+        result = orjson.loads(buffer)
+        if semantic_cache is not None:
+            with semantic_cache_lock:
+                semantic_put(chunk_key, buffer, cache_obj=semantic_cache)
+    return result.get("sentiment", {}), {"key_phrases": result.get("key_phrases", []), "feedback": result.get("feedback", [])}
+
+# Run blocking work off the event loop with this session's script context attached, so
+# Streamlit APIs used there (st.cache_data, st.session_state) behave as on the script thread
+async def run_in_thread(func, *args):
+    ctx = get_script_run_ctx()
+
+    def call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+
+    return await asyncio.to_thread(call)
+
+async def analyze_chunk_async(chunk, on_partial=None):
+    try:
+        # Input tokens drive latency, so bound long monologues to the tail of the chunk;
+        # special-token text like "<|endoftext|>" is encoded as plain text, not rejected
+        ids = encoder.encode(chunk, disallowed_special=())
+        if len(ids) > CHUNK_TOKEN_BUDGET:
+            chunk = encoder.decode(ids[-CHUNK_TOKEN_BUDGET:])
+        # The blocking LLM stream runs off the event loop; failures raise out of
+        # run_analysis, so the fallback below is never cached
+        return await run_in_thread(run_analysis, " ".join(chunk.lower().split()), chunk, on_partial)
     except Exception as e:
-        st.error(f"Analysis error: {str(e)}")
+        # Runs inside an event-loop task, so it is recorded for the panel instead of drawn here
+        st.session_state.stream_notices.append(("error", f"Analysis error: {str(e)}"))
         return {"positive": 0, "negative": 0, "neutral": 0}, {"key_phrases": [], "feedback": []}
 
-# Log to HubSpot
-def log_to_hubspot(transcript, results):
+# Rolling mean over the last `window` entries of one sentiment series
+@njit(cache=True)
+def rolling_mean(values, window):
+    out = np.empty_like(values)
+    total = 0.0
+    for i in range(values.shape[0]):
+        total += values[i]
+        if i >= window:
+            total -= values[i - window]
+        out[i] = total / min(i + 1, window)
+    return out
+
+def record_sentiment(index, sentiment):
+    state = st.session_state
+    slot = index - state.sentiment_offset
+    if slot < 0:
+        return  # Already shifted out of the history
+    if slot >= SENTIMENT_HISTORY_CAP:
+        # Full: drop the oldest entries so this chunk lands in the last slot
+        shift = slot - SENTIMENT_HISTORY_CAP + 1
+        for series in (state.sent_pos, state.sent_neg, state.sent_neu, state.sent_filled):
+            series[:-shift] = series[shift:]
+            series[-shift:] = 0
+        state.sentiment_offset += shift
+        state.sentiment_count = max(0, state.sentiment_count - shift)
+        slot -= shift
+    state.sent_pos[slot] = sentiment.get("positive", 0)
+    state.sent_neg[slot] = sentiment.get("negative", 0)
+    state.sent_neu[slot] = sentiment.get("neutral", 0)
+    state.sent_filled[slot] = True
+    while state.sentiment_count < SENTIMENT_HISTORY_CAP and state.sent_filled[state.sentiment_count]:
+        state.sentiment_count += 1
+
+# Log to HubSpot (scheduled on the HubSpot loop; errors surface through the returned future)
+def retry_delay(response, attempt):
+    # Honour Retry-After (seconds or an HTTP date) when HubSpot sends it, else back off exponentially
+    value = response.headers.get("Retry-After") if response is not None else None
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+    return 0.5 * 2 ** attempt
+
+async def post_to_hubspot(payload):
+    for attempt in range(HUBSPOT_MAX_ATTEMPTS):
+        last_attempt = attempt == HUBSPOT_MAX_ATTEMPTS - 1
+        await hubspot_slots.acquire()
+        # Each request holds its slot for a full window, which caps the burst rate
+        hubspot_loop.call_later(HUBSPOT_WINDOW, hubspot_slots.release)
+        try:
+            response = await hubspot_client.post("https://api.hubapi.com/crm/v3/objects/engagements", json=payload)
+        except httpx.TransportError:
+            # Connection failures and timeouts are retried like retryable statuses
+            if last_attempt:
+                raise
+            response = None
+        else:
+            if response.status_code not in HUBSPOT_RETRY_STATUSES or last_attempt:
+                return response
+        await asyncio.sleep(retry_delay(response, attempt))
+
+async def log_to_hubspot(transcript_parts, results):
+    transcript = "\n".join(transcript_parts)
+    response = await post_to_hubspot({
+        "properties": {
+            "hs_call_notes": f"{transcript}\n\nAnalysis:\nSentiment: {results['sentiment']}\nKey Phrases: {sorted(results['key_phrases'])}\nFeedback: {results['feedback']}",
+            "hs_call_to_number": "+1 (582) 203-8284",
+            "hs_call_disposition": "Cold Call",
+            "hs_timestamp": "2025-08-20T04:17:00Z"
+        },
+        "associations": [{"to": {"id": CONTACT_ID}, "types": [{"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": 5}]}]
+    })
+    return response.status_code == 201
+
+# Analysis results are applied on the script thread, between awaits of the real-time loop
+def apply_partial(index, buffer):
+    partial = parse_partial_json(buffer) or {}
+    st.session_state.live_analysis = buffer
+    # The sentiment object is closed once the model has moved on to key_phrases
+    if "key_phrases" in partial and index > st.session_state.latest_chunk:
+        st.session_state.latest_chunk = index
+        st.session_state.results["sentiment"] = partial.get("sentiment", {})
+
+# Called on the LLM thread for each streamed token batch
+def forward_partial(run, index, buffer):
+    if run["stopped"].is_set():
+        # The run is over and its loop may be closed; abort the LLM stream instead of paying for it
+        raise asyncio.CancelledError()
     try:
-        response = requests.post(
-            "https://api.hubapi.com/crm/v3/objects/engagements",
-            headers={"Authorization": f"Bearer {HUBSPOT_API_KEY}"},
-            json={
-                "properties": {
-                    "hs_call_notes": f"{transcript}\n\nAnalysis:\nSentiment: {results['sentiment']}\nKey Phrases: {results['key_phrases']}\nFeedback: {results['feedback']}",
-                    "hs_call_to_number": "+1 (582) 203-8284",
-                    "hs_call_disposition": "Cold Call",
-                    "hs_timestamp": "2025-08-20T04:17:00Z"
-                },
-                "associations": [{"to": {"id": CONTACT_ID}, "types": [{"associationCategory": "HUBSPOT_DEFINED", "associationTypeId": 5}]}]
-            }
+        run["loop"].call_soon_threadsafe(apply_partial, index, buffer)
+    except RuntimeError:
+        # Loop closed between the check and the call
+        raise asyncio.CancelledError()
+
+async def analyze_and_record(run, index, chunk):
+    sentiment, feedback = await analyze_chunk_async(chunk, functools.partial(forward_partial, run, index))
+    st.session_state.live_analysis = ""
+    # Analyses can finish out of order; only the newest chunk sets the current sentiment
+    if index >= st.session_state.latest_chunk:
+        st.session_state.latest_chunk = index
+        st.session_state.results["sentiment"] = sentiment
+    record_sentiment(index, sentiment)
+    # Model output is untrusted; skip anything that is not a plain string phrase
+    st.session_state.results["key_phrases"].update(phrase.strip() for phrase in feedback.get("key_phrases", []) if isinstance(phrase, str))
+    st.session_state.results["feedback"].extend(feedback.get("feedback", []))
+
+# AssemblyAI callbacks run on the SDK's own thread; attaching the session's script context
+# lets them reach st.session_state, and the chunks are handed to the running event loop
+def on_transcript(ctx, data):
+    add_script_run_ctx(threading.current_thread(), ctx)
+    sink = st.session_state.get("chunk_sink")
+    if data.text and sink is not None and not sink[0].is_closed():
+        loop, chunks = sink
+        loop.call_soon_threadsafe(chunks.put_nowait, data.text)
+
+def on_transcriber_error(ctx, error):
+    add_script_run_ctx(threading.current_thread(), ctx)
+    st.error(f"Transcription error: {error}")
+
+def on_transcriber_close(ctx):
+    add_script_run_ctx(threading.current_thread(), ctx)
+    # The server ended the session; connect a fresh transcriber on the next start
+    st.session_state.pop("transcriber", None)
+
+def close_idle_transcriber(ctx, transcriber):
+    add_script_run_ctx(threading.current_thread(), ctx)
+    # Forget it first so a start racing this close connects a fresh transcriber
+    if st.session_state.get("transcriber") is transcriber:
+        del st.session_state.transcriber
+    transcriber.close()
+
+# One connected transcriber per browser session, reused across starts so the
+# WebSocket handshake is paid once; it is closed after TRANSCRIBER_IDLE_TIMEOUT
+# without a run so abandoned sessions do not keep a billed connection open
+def get_transcriber():
+    idle_timer = st.session_state.pop("transcriber_idle_timer", None)
+    if idle_timer is not None:
+        idle_timer.cancel()
+    if "transcriber" not in st.session_state:
+        ctx = get_script_run_ctx()
+        transcriber = aai.RealtimeTranscriber(
+            on_data=functools.partial(on_transcript, ctx),
+            on_error=functools.partial(on_transcriber_error, ctx),
+            on_close=functools.partial(on_transcriber_close, ctx)
         )
-        return response.status_code == 201
+        transcriber.connect()
+        st.session_state.transcriber = transcriber
+    return st.session_state.transcriber
+
+def release_transcriber():
+    transcriber = st.session_state.get("transcriber")
+    if transcriber is None:
+        return
+    idle_timer = threading.Timer(TRANSCRIBER_IDLE_TIMEOUT, close_idle_transcriber, args=(get_script_run_ctx(), transcriber))
+    idle_timer.daemon = True
+    idle_timer.start()
+    st.session_state.transcriber_idle_timer = idle_timer
+
+# Call audio source: AssemblyAI transcripts, or the sample call paced like a live call
+async def stream_call_audio(run, chunks):
+    try:
+        # Connecting is a blocking WebSocket handshake, so it stays off the event loop too
+        transcriber = await run_in_thread(get_transcriber)
+        # Simulate HubSpot call audio (replace with SDK stream)
+        run["audio_active"] = True  # Tells stop_stream the transcriber is mid-stream
+        try:
+            await run_in_thread(transcriber.stream_file, "sample_call.wav")  # Replace with HubSpot SDK audio stream
+            audio_found = True
+        except FileNotFoundError:
+            audio_found = False
+        finally:
+            run["audio_active"] = False
+        if not audio_found:
+            st.session_state.stream_notices.append(("warning", "Audio file not found. Simulating with sample transcript..."))
+            for chunk in transcript_chunks:
+                await chunks.put(chunk)
+                await asyncio.sleep(3)
     except Exception as e:
-        st.error(f"HubSpot logging error: {str(e)}")
-        return False
-
-# Real-time transcription with AssemblyAI
-def transcribe_real_time():
-    transcriber = aai.RealtimeTranscriber(
-        on_data=lambda data: (
-            setattr(st.session_state, "transcript", st.session_state.transcript + data.text + " "),
-            st.session_state.results.update(analyze_chunk(data.text)),
-            st.rerun()
-        ),
-        on_error=lambda error: st.error(f"Transcription error: {error}")
-    )
-    transcriber.connect()
-    # Simulate HubSpot call audio (replace with SDK stream)
+        st.session_state.stream_notices.append(("error", f"Transcription error: {str(e)}"))
+    finally:
+        # Always end the stream, even if the audio source failed
+        chunks.put_nowait(None)
+
+# Real-time loop: yields each new transcript chunk to the script while each chunk's analysis
+# runs as a task on the same event loop. Only this coroutine and the script call st.* elements:
+# Streamlit's rerun/stop exceptions raised inside a task would be swallowed by asyncio instead of
+# ending the stream, so the tasks only update session_state and the panel is redrawn from here.
+# Task handles live in `run` so drive_stream can cancel them when the run ends.
+async def transcript_stream(results_area, run):
+    chunks = asyncio.Queue()
+    st.session_state.chunk_sink = (asyncio.get_running_loop(), chunks)
+    source = asyncio.create_task(stream_call_audio(run, chunks))
+    analyses = []
+    getter = asyncio.ensure_future(chunks.get())
+    run["tasks"].update((source, getter))
+    while True:
+        # Redraw about once a second while waiting; a pending get is never cancelled,
+        # so no chunk is lost on timeout
+        done, _ = await asyncio.wait({getter}, timeout=1.0)
+        if not done:
+            with results_area.container():
+                render_results()
+            continue
+        chunk = getter.result()
+        if chunk is None:
+            break
+        getter = asyncio.ensure_future(chunks.get())
+        st.session_state.transcript_parts.append(chunk)
+        analyses.append(asyncio.create_task(analyze_and_record(run, len(analyses), chunk)))
+        run["tasks"].update((getter, analyses[-1]))
+        yield chunk
+    pending = {source, *analyses}
+    while pending:
+        _, pending = await asyncio.wait(pending, timeout=1.0)
+        with results_area.container():
+            render_results()
+
+# Per-run cleanup of everything running outside the event loop
+def stop_stream(run):
+    run["stopped"].set()  # LLM threads stop forwarding (and streaming) partial output
+    st.session_state.chunk_sink = None  # AssemblyAI callbacks stop feeding the old loop
+    if run["audio_active"]:
+        # Interrupted mid-call: closing the connection stops stream_file from sending audio
+        transcriber = st.session_state.pop("transcriber", None)
+        if transcriber is not None:
+            threading.Thread(target=transcriber.close, daemon=True).start()
+
+# Sync driver for the async real-time loop on an event loop this script owns. Streamlit's own
+# async-generator bridge closes its loop without cancelling pending tasks, so the loop is run
+# here and torn down in order: stop outside work first (while audio_active is still accurate),
+# then cancel and await the tasks, finalize async generators, and only then close the loop.
+def drive_stream(agen, run):
+    loop = asyncio.new_event_loop()
+    run["loop"] = loop
     try:
-        transcriber.stream_file("sample_call.wav")  # Replace with HubSpot SDK audio stream
-    except FileNotFoundError:
-        st.warning("Audio file not found. Simulating with sample transcript...")
-        for chunk in [
-            "Agent: Hello, this is a test discovery call from Test Corp. We provide customized marketing solutions to enhance your business growth. Can you share your current marketing challenges?",
-            "Prospect: We’re struggling with lead generation and need better ROI on our campaigns.",
-            "Agent: That’s a common challenge. Our solutions can optimize your campaigns using data-driven strategies. Can you describe your target audience?",
-            "Prospect: Mostly small businesses. I’d like to know more about your pricing and implementation process.",
-            "Agent: Let’s schedule a follow-up to discuss pricing and tailor a plan. Does next week work?",
-            "Prospect: Yes, let’s do Tuesday."
-        ]:
-            if not st.session_state.running:
-                break
-            st.session_state.transcript += chunk + "\n"
-            sentiment, feedback = analyze_chunk(chunk)
-            st.session_state.results["sentiment"] = sentiment
-            st.session_state.results["key_phrases"].extend(feedback.get("key_phrases", []))
-            st.session_state.results["feedback"].extend(feedback.get("feedback", []))
-            st.rerun()
-            time.sleep(3)
-    transcriber.close()
-    st.session_state.running = False
+        while True:
+            try:
+                yield loop.run_until_complete(anext(agen))
+            except StopAsyncIteration:
+                return
+    finally:
+        stop_stream(run)
+        tasks = [task for task in run["tasks"] if not task.done()]
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+# Transcript panel; only the recent window goes to the browser unless the rep asks for everything
+def draw_transcript(area, show_full, key=None):
+    transcript_parts = st.session_state.transcript_parts if show_full else st.session_state.transcript_parts[-TRANSCRIPT_WINDOW:]
+    area.text_area("Transcript", "\n".join(transcript_parts), height=200, disabled=True, key=key)
+
+# Results panel, drawn into whichever container is active
+def render_results():
+    live_analysis = st.session_state.live_analysis
+    results = st.session_state.results
+    count = st.session_state.sentiment_count
+    for level, message in st.session_state.stream_notices:
+        if level == "warning":
+            st.warning(message)
+        else:
+            st.error(message)
+    if live_analysis:
+        st.caption("Analyzing latest chunk...")
+        st.code(live_analysis, language="json")
+    if results["sentiment"]:
+        st.write("**Sentiment Analysis**")
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Positive", f"{results['sentiment'].get('positive', 0):.2f}")
+        col2.metric("Negative", f"{results['sentiment'].get('negative', 0):.2f}")
+        col3.metric("Neutral", f"{results['sentiment'].get('neutral', 0):.2f}")
+        # Sentiment chart
+        st.write("**Sentiment Distribution**")
+        sentiment_df = pd.DataFrame([results["sentiment"]], index=["Sentiment"])
+        sentiment_df = sentiment_df.rename(columns={"positive": "Positive", "negative": "Negative", "neutral": "Neutral"})
+        st.bar_chart(sentiment_df)
+        if count > 1:
+            st.write("**Sentiment Trend**")
+            trend = {
+                "Positive": rolling_mean(st.session_state.sent_pos[:count], SENTIMENT_WINDOW),
+                "Negative": rolling_mean(st.session_state.sent_neg[:count], SENTIMENT_WINDOW),
+                "Neutral": rolling_mean(st.session_state.sent_neu[:count], SENTIMENT_WINDOW)
+            }
+            st.line_chart(pd.DataFrame(trend, copy=False))
+
+    if results["key_phrases"]:
+        st.write("**Key Phrases**")
+        # One markdown element instead of one st.write message per phrase
+        st.markdown("\n".join(f"- {phrase}" for phrase in sorted(results["key_phrases"])))
+
+    if results["feedback"]:
+        st.write("**Feedback for Improvement**")
+        st.markdown("\n".join(f"- {item}" for item in results["feedback"]))
 
 # UI controls
 col1, col2 = st.columns(2)
 with col1:
-    if st.button("Start Real-Time Transcription and Analysis"):
-        if not st.session_state.running:
-            st.session_state.running = True
-            st.session_state.transcript = ""
-            st.session_state.results = {"sentiment": {}, "key_phrases": [], "feedback": []}
-            threading.Thread(target=transcribe_real_time, daemon=True).start()
+    start = st.button("Start Real-Time Transcription and Analysis")
 with col2:
-    if st.button("Stop Analysis"):
-        st.session_state.running = False
+    # Any click reruns the script; the next redraw in the real-time loop raises it,
+    # which ends an in-progress stream
+    st.button("Stop Analysis")
+
+# Disabled while a call is streaming: any click would rerun the script and end the live analysis
+if st.button("Log to HubSpot", disabled=start):
+    transcript_parts, results = list(st.session_state.transcript_parts), copy.deepcopy(st.session_state.results)
+    st.session_state.hubspot_future = asyncio.run_coroutine_threadsafe(log_to_hubspot(transcript_parts, results), hubspot_loop)
 
-if st.button("Log to HubSpot"):
-    if log_to_hubspot(st.session_state.transcript, st.session_state.results):
+# Poll only while a HubSpot request is in flight; idle sessions get no timed reruns
+hubspot_pending = "hubspot_future" in st.session_state and not st.session_state.hubspot_future.done()
+
+@st.fragment(run_every=1.0 if hubspot_pending else None)
+def hubspot_status():
+    hubspot_future = st.session_state.get("hubspot_future")
+    if hubspot_future is None:
+        return
+    if not hubspot_future.done():
+        st.info("Logging to HubSpot...")
+    elif hubspot_pending:
+        # Finished since polling started: one full rerun shows the result and drops the timer
+        st.rerun()
+    elif hubspot_future.exception() is not None:
+        st.error(f"HubSpot logging error: {str(hubspot_future.exception())}")
+    elif hubspot_future.result():
         st.success("Logged to HubSpot!")
     else:
         st.error("Failed to log to HubSpot.")
 
+hubspot_status()
+
 # Display transcript
 st.subheader("Live Transcript")
-st.text_area("Transcript", st.session_state.transcript, height=200, disabled=True)
+show_full = st.toggle("Show full transcript", key="show_full_transcript", disabled=start)
+transcript_area = st.empty()
 
 # Display results
 st.subheader("Real-Time Analysis Results")
-if st.session_state.results["sentiment"]:
-    st.write("**Sentiment Analysis**")
-    col1, col2, col3 = st.columns(3)
-    col1.metric("Positive", f"{st.session_state.results['sentiment'].get('positive', 0):.2f}")
-    col2.metric("Negative", f"{st.session_state.results['sentiment'].get('negative', 0):.2f}")
-    col3.metric("Neutral", f"{st.session_state.results['sentiment'].get('neutral', 0):.2f}")
-    # Sentiment chart
-    st.write("**Sentiment Distribution**")
-    sentiment_df = pd.DataFrame([st.session_state.results["sentiment"]], index=["Sentiment"])
-    sentiment_df = sentiment_df.rename(columns={"positive": "Positive", "negative": "Negative", "neutral": "Neutral"})
-    st.bar_chart(sentiment_df)
-
-if st.session_state.results["key_phrases"]:
-    st.write("**Key Phrases**")
-    for phrase in st.session_state.results["key_phrases"]:
-        st.write(f"- {phrase}")
-
-if st.session_state.results["feedback"]:
-    st.write("**Feedback for Improvement**")
-    for item in st.session_state.results["feedback"]:
-        st.write(f"- {item}")
\ No newline at end of file
+results_area = st.empty()
+
+if start:
+    st.session_state.transcript_parts = []
+    st.session_state.results = {"sentiment": {}, "key_phrases": set(), "feedback": []}
+    reset_sentiment_history()
+    st.session_state.latest_chunk = -1
+    st.session_state.stream_notices = []
+    run = {"loop": None, "tasks": set(), "stopped": threading.Event(), "audio_active": False}
+    stream = drive_stream(transcript_stream(results_area, run), run)
+    try:
+        for _ in stream:
+            # Each chunk replaces the windowed view instead of appending to an ever-growing
+            # stream element; the key (one chunk per draw) keeps the widget IDs distinct
+            draw_transcript(transcript_area, show_full, key=f"live_transcript_{len(st.session_state.transcript_parts)}")
+    finally:
+        # A rerun raised by a redraw here leaves the driver suspended; closing it
+        # runs the teardown now rather than whenever the generator is collected
+        stream.close()
+        release_transcriber()
+
+draw_transcript(transcript_area, show_full)
+with results_area.container():
+    render_results()